@@ -3,19 +3,22 @@ from __future__ import annotations
 from typing import Any, Dict
 
 from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException
+from sqlalchemy.orm import noload, selectinload
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.core.socket_manager import socket_manager
-from app.db.models import AgentLog, ResearchBranch, ResearchSession, ResearchTask, KnowledgeFact
+from app.db.models import AgentLog, KnowledgeFact, ResearchBranch, ResearchSession
 from app.db.session import get_session
 from app.services import gemini_service
-from app.services.gemini_service import QuotaExhaustedError
 from app.workers.tasks import run_research_loop
 
 
 router = APIRouter(prefix="/research", tags=["research"])
 
+# Hard cap on /stt uploads so one request cannot spike RSS unboundedly
+MAX_AUDIO_BYTES = 25 * 1024 * 1024
+
 
 @router.get("/health")
 async def health_check() -> Dict[str, str]:
@@ -28,8 +31,10 @@ async def start_research(
     session: AsyncSession = Depends(get_session),
 ) -> Dict[str, Any]:
     """
-    Create a new ResearchSession, ask Gemini to orchestrate the plan,
-    persist branches/tasks, then enqueue the Celery research loop.
+    Create a new ResearchSession and enqueue the Celery research loop.
+    Plan orchestration and branch/task persistence happen in the worker,
+    which streams progress over the session websocket — the request
+    returns after a single insert.
     """
     prompt = payload.get("prompt", "").strip()
     attachments = payload.get("attachments") or []
@@ -41,42 +46,13 @@ async def start_research(
     await session.commit()
     await session.refresh(research_session)
 
-    # Call Gemini to get branches/tasks (include any attached context)
-    try:
-        branches = await gemini_service.orchestrate_plan(prompt, attachments)
-    except QuotaExhaustedError as e:
-        # Mark session as failed and return user-friendly error
-        research_session.status = "failed"
-        await session.commit()
-        raise HTTPException(status_code=503, detail=str(e)) from e
-
-    # Persist branches and tasks
-    for branch_data in branches:
-        branch = ResearchBranch(
-            session_id=research_session.id,
-            name=branch_data.get("name", "Branch"),
-            status="active",
-        )
-        session.add(branch)
-        await session.commit()
-        await session.refresh(branch)
-
-        for task_data in branch_data.get("tasks", []):
-            task = ResearchTask(
-                branch_id=branch.id,
-                description=task_data.get("description", ""),
-                assigned_to=task_data.get("assigned_to", "Agent"),
-                status=task_data.get("status", "pending"),
-                priority=task_data.get("priority", 5),
-                dependencies=task_data.get("dependencies") or [],
-            )
-            session.add(task)
-        await session.commit()
-
-    # Kick off Celery worker
-    run_research_loop.delay(research_session.id)
+    # Kick off Celery worker; it calls Gemini and persists the plan.
+    # User-initiated sessions get mid-range priority on the research queue.
+    run_research_loop.apply_async(
+        args=(research_session.id, prompt, attachments), priority=5
+    )
 
-    return {"session_id": research_session.id}
+    return {"session_id": research_session.id, "status": "pending"}
 
 
 @router.get("/{session_id}")
@@ -87,23 +63,27 @@ async def get_research_state(
     """
     Return full state for a session: branches, tasks, logs, knowledge facts.
     """
-    res = await db.exec(select(ResearchSession).where(ResearchSession.id == session_id))
+    # One eager-loaded query for the whole session graph instead of a
+    # SELECT per branch (N+1); the selectin loads batch into ~4 statements.
+    # Logs and facts are noload'd here — their lazy="selectin" default would
+    # otherwise hydrate both collections only for the column selects below
+    # to fetch the same rows again.
+    res = await db.exec(
+        select(ResearchSession)
+        .where(ResearchSession.id == session_id)
+        .options(
+            selectinload(ResearchSession.branches).selectinload(ResearchBranch.tasks),
+            noload(ResearchSession.logs),
+            noload(ResearchSession.knowledge_facts),
+        )
+    )
     session_obj = res.one_or_none()
     if not session_obj:
         return {"error": "session not found"}
 
-    # Branches and tasks
-    branches_res = await db.exec(
-        select(ResearchBranch).where(ResearchBranch.session_id == session_id)
-    )
-    branches = branches_res.all()
-
     result_branches: list[dict[str, Any]] = []
-    for branch in branches:
-        tasks_res = await db.exec(
-            select(ResearchTask).where(ResearchTask.branch_id == branch.id)
-        )
-        tasks = tasks_res.all()
+    for branch in session_obj.branches:
+        tasks = branch.tasks
         result_branches.append(
             {
                 "id": branch.id,
@@ -126,15 +106,25 @@ async def get_research_state(
             }
         )
 
-    # Logs
+    # Logs and facts are read-only here: column selects return plain rows
+    # and skip hydrating (potentially thousands of) ORM instances.
     logs_res = await db.exec(
-        select(AgentLog).where(AgentLog.session_id == session_id).order_by(AgentLog.timestamp)
+        select(AgentLog.id, AgentLog.agent_name, AgentLog.message, AgentLog.type, AgentLog.timestamp)
+        .where(AgentLog.session_id == session_id)
+        # id tie-break: server-side now() is the transaction timestamp, so
+        # logs written in one transaction share it exactly
+        .order_by(AgentLog.timestamp, AgentLog.id)
     )
     logs = logs_res.all()
 
-    # Knowledge
     facts_res = await db.exec(
-        select(KnowledgeFact).where(KnowledgeFact.session_id == session_id)
+        select(
+            KnowledgeFact.id,
+            KnowledgeFact.content,
+            KnowledgeFact.source_agent,
+            KnowledgeFact.confidence,
+            KnowledgeFact.created_at,
+        ).where(KnowledgeFact.session_id == session_id)
     )
     facts = facts_res.all()
 
@@ -149,23 +139,23 @@ async def get_research_state(
         "branches": result_branches,
         "logs": [
             {
-                "id": log.id,
-                "agent_name": log.agent_name,
-                "message": log.message,
-                "type": log.type,
-                "timestamp": log.timestamp.isoformat(),
+                "id": log_id,
+                "agent_name": agent_name,
+                "message": message,
+                "type": log_type,
+                "timestamp": timestamp.isoformat(),
             }
-            for log in logs
+            for log_id, agent_name, message, log_type, timestamp in logs
         ],
         "knowledge": [
             {
-                "id": fact.id,
-                "content": fact.content,
-                "source_agent": fact.source_agent,
-                "confidence": fact.confidence,
-                "created_at": fact.created_at.isoformat(),
+                "id": fact_id,
+                "content": content,
+                "source_agent": source_agent,
+                "confidence": confidence,
+                "created_at": created_at.isoformat(),
             }
-            for fact in facts
+            for fact_id, content, source_agent, confidence, created_at in facts
         ],
     }
 
@@ -193,9 +183,12 @@ async def transcribe_speech(
     Backend speech-to-text endpoint.
     Accepts an audio file upload and returns a transcript using Gemini.
     """
-    data = await file.read()
+    # Bounded read: never buffer more than the cap (+1 byte to detect overflow)
+    data = await file.read(MAX_AUDIO_BYTES + 1)
     if not data:
         raise HTTPException(status_code=400, detail="Empty audio file")
+    if len(data) > MAX_AUDIO_BYTES:
+        raise HTTPException(status_code=413, detail="Audio file too large (25 MB max)")
 
     mime_type = file.content_type or "audio/webm"
     try:
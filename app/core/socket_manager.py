@@ -1,43 +1,162 @@
-from __future__ import annotations
-
-from typing import Dict, List
-
-from fastapi import WebSocket
-
-
-class WebSocketManager:
-    """
-    Keeps track of active WebSocket connections per research session.
-    This is an in-process manager; for multiple workers/processes you would
-    back this with Redis pub/sub or similar.
-    """
-
-    def __init__(self) -> None:
-        self._connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, session_id: str, websocket: WebSocket) -> None:
-        await websocket.accept()
-        self._connections.setdefault(session_id, []).append(websocket)
-
-    def disconnect(self, session_id: str, websocket: WebSocket) -> None:
-        conns = self._connections.get(session_id)
-        if not conns:
-            return
-        if websocket in conns:
-            conns.remove(websocket)
-        if not conns:
-            self._connections.pop(session_id, None)
-
-    async def send_json(self, session_id: str, message: dict) -> None:
-        conns = self._connections.get(session_id, [])
-        for ws in list(conns):
-            try:
-                await ws.send_json(message)
-            except Exception:
-                # Drop broken connection
-                self.disconnect(session_id, ws)
-
-
-socket_manager = WebSocketManager()
-
-
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Dict
+
+import orjson
+import redis.asyncio as aioredis
+from fastapi import WebSocket
+
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Max messages coalesced into a single websocket frame.
+_BATCH_MAX = 64
+
+# Redis channel prefix for per-session fanout.
+_CHANNEL_PREFIX = "session:"
+
+
+class _Connection:
+    """A websocket together with its outbound queue and flusher task."""
+
+    def __init__(self, websocket: WebSocket) -> None:
+        self.websocket = websocket
+        self.queue: asyncio.Queue[dict] = asyncio.Queue()
+        self.flusher: asyncio.Task | None = None
+
+
+class WebSocketManager:
+    """
+    Keeps track of active WebSocket connections per research session.
+
+    Messages are fanned out through Redis pub/sub: `send_json` publishes to
+    `session:{id}` and every web process relays subscribed events to its own
+    local sockets, so Celery workers and multiple uvicorn processes can all
+    push updates to any connected browser. If Redis is unreachable we fall
+    back to in-process delivery.
+
+    Outbound messages are queued per connection and drained by a background
+    flusher that coalesces up to _BATCH_MAX pending messages into one
+    {"batch": [...]} frame — bursts of small progress events cost a single
+    frame instead of one frame (plus TCP/TLS overhead) each.
+    """
+
+    def __init__(self) -> None:
+        # Keyed by websocket per session: O(1) add/remove instead of the
+        # O(n) list scan on every disconnect.
+        self._connections: Dict[str, Dict[WebSocket, _Connection]] = {}
+        self._redis: aioredis.Redis | None = None
+        self._pubsub: aioredis.client.PubSub | None = None
+        self._relay_task: asyncio.Task | None = None
+
+    # -- Redis fanout ------------------------------------------------------
+
+    def _get_redis(self) -> aioredis.Redis:
+        if self._redis is None:
+            self._redis = aioredis.from_url(get_settings().REDIS_URL)
+        return self._redis
+
+    async def start(self) -> None:
+        """Subscribe to session channels and relay events to local sockets."""
+        if self._relay_task is not None:
+            return
+        self._relay_task = asyncio.create_task(self._relay_loop())
+
+    async def stop(self) -> None:
+        if self._relay_task is not None:
+            self._relay_task.cancel()
+            self._relay_task = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    async def _relay_loop(self) -> None:
+        # (Re)subscribe forever: a transient Redis failure must not kill the
+        # relay, or every websocket in this process silently goes quiet while
+        # publishes elsewhere keep succeeding.
+        backoff = 1.0
+        while True:
+            try:
+                self._pubsub = self._get_redis().pubsub()
+                await self._pubsub.psubscribe(f"{_CHANNEL_PREFIX}*")
+                backoff = 1.0
+                async for msg in self._pubsub.listen():
+                    if msg.get("type") != "pmessage":
+                        continue
+                    channel = msg["channel"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    session_id = channel[len(_CHANNEL_PREFIX):]
+                    try:
+                        self._deliver_local(session_id, orjson.loads(msg["data"]))
+                    except Exception as exc:  # pragma: no cover - malformed event
+                        logger.debug("Dropping malformed pub/sub event: %s", exc)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning(
+                    "Pub/sub relay lost its Redis connection, retrying in %.0fs: %s",
+                    backoff,
+                    exc,
+                )
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    # -- Connection lifecycle ---------------------------------------------
+
+    async def connect(self, session_id: str, websocket: WebSocket) -> None:
+        await websocket.accept()
+        conn = _Connection(websocket)
+        conn.flusher = asyncio.create_task(self._flush_loop(session_id, conn))
+        self._connections.setdefault(session_id, {})[websocket] = conn
+
+    def disconnect(self, session_id: str, websocket: WebSocket) -> None:
+        conns = self._connections.get(session_id)
+        if not conns:
+            return
+        conn = conns.pop(websocket, None)
+        if conn is not None and conn.flusher is not None:
+            conn.flusher.cancel()
+        if not conns:
+            self._connections.pop(session_id, None)
+
+    # -- Sending -----------------------------------------------------------
+
+    async def send_json(self, session_id: str, message: dict) -> None:
+        try:
+            await self._get_redis().publish(
+                f"{_CHANNEL_PREFIX}{session_id}", orjson.dumps(message)
+            )
+            return
+        except Exception as exc:
+            logger.debug("Redis publish failed, delivering locally: %s", exc)
+        self._deliver_local(session_id, message)
+
+    def _deliver_local(self, session_id: str, message: dict) -> None:
+        # Snapshot so a concurrent disconnect can't mutate during iteration
+        for conn in tuple(self._connections.get(session_id, {}).values()):
+            conn.queue.put_nowait(message)
+
+    async def _flush_loop(self, session_id: str, conn: _Connection) -> None:
+        try:
+            while True:
+                batch = [await conn.queue.get()]
+                while not conn.queue.empty() and len(batch) < _BATCH_MAX:
+                    batch.append(conn.queue.get_nowait())
+                # Encode once with orjson and send as a binary frame: avoids
+                # starlette's per-send stdlib json.dumps and its str->bytes copy.
+                await conn.websocket.send_bytes(orjson.dumps({"batch": batch}))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Drop broken connection
+            self.disconnect(session_id, conn.websocket)
+
+
+socket_manager = WebSocketManager()
@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import Optional, List, TYPE_CHECKING
 
-from sqlalchemy import Column
+from sqlalchemy import Column, DateTime, Index, func, text
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlmodel import Field, Relationship, SQLModel
 
@@ -22,6 +22,16 @@ class ResearchSession(SQLModel, table=True):
 
 
 class ResearchBranch(SQLModel, table=True):
+    # Tiny partial index over just the active branches: worker polling reads
+    # far fewer pages than the full status B-tree as the table grows.
+    __table_args__ = (
+        Index(
+            "idx_branch_active",
+            "session_id",
+            postgresql_where=text("status = 'active'"),
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     session_id: int = Field(foreign_key="researchsession.id", index=True)
     name: str
@@ -33,6 +43,24 @@ class ResearchBranch(SQLModel, table=True):
 
 
 class ResearchTask(SQLModel, table=True):
+    # Partial indexes over the pending rows only — the "ready work" set the
+    # research loop polls stays small and cache-resident. The composite
+    # (priority DESC, id) index matches the claim query's ordering exactly,
+    # so picking the next batch is an index-range scan with no sort.
+    __table_args__ = (
+        Index(
+            "idx_task_pending",
+            "branch_id",
+            postgresql_where=text("status = 'pending'"),
+        ),
+        Index(
+            "ix_task_pending_pri",
+            text("priority DESC"),
+            "id",
+            postgresql_where=text("status = 'pending'"),
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     branch_id: int = Field(foreign_key="researchbranch.id", index=True)
 
@@ -64,12 +92,22 @@ class AgentLog(SQLModel, table=True):
     agent_name: str
     message: str
     type: str = Field(default="info", index=True)
-    timestamp: datetime = Field(default_factory=datetime.utcnow, index=True)
+    # Stamped by Postgres at insert time: no per-row clock read in Python,
+    # and bulk inserts don't have to ship a timestamp per row.
+    timestamp: Optional[datetime] = Field(
+        default=None,
+        sa_column=Column(
+            DateTime(), server_default=func.now(), nullable=False, index=True
+        ),
+    )
 
     session: Optional[ResearchSession] = Relationship(back_populates="logs")
 
 
 class KnowledgeFact(SQLModel, table=True):
+    # Supports the incremental context query: session_id = ? AND id > ?
+    __table_args__ = (Index("ix_fact_session_id", "session_id", "id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     session_id: int = Field(foreign_key="researchsession.id", index=True)
 
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from app.services.gemini_service import QuotaExhaustedError
+
+logger = logging.getLogger(__name__)
+
+
+class AIMDController:
+    """
+    Additive-increase / multiplicative-decrease concurrency controller for
+    Gemini calls. Successful calls at or under the latency target grow the
+    allowed concurrency by `alpha`; quota/rate-limit failures multiply it by
+    `beta` and open a cooldown window during which new calls wait. This keeps
+    sustained throughput near the provider's RPM/TPM ceiling without tripping
+    hard 429 storms.
+    """
+
+    def __init__(
+        self,
+        initial: float = 2.0,
+        minimum: float = 1.0,
+        maximum: float = 16.0,
+        alpha: float = 0.5,
+        beta: float = 0.5,
+        latency_target: float = 15.0,
+        cooldown: float = 15.0,
+    ) -> None:
+        self._limit = initial
+        self._min = minimum
+        self._max = maximum
+        self._alpha = alpha
+        self._beta = beta
+        self._latency_target = latency_target
+        self._cooldown = cooldown
+        self._in_flight = 0
+        self._resume_at = 0.0
+
+    @property
+    def limit(self) -> int:
+        return max(1, int(self._limit))
+
+    async def _wait_for_slot(self) -> None:
+        # Plain polling keeps the controller usable across event loops
+        # (each Celery invocation currently runs its own loop).
+        while True:
+            now = time.monotonic()
+            if now < self._resume_at:
+                await asyncio.sleep(self._resume_at - now)
+                continue
+            if self._in_flight < self.limit:
+                return
+            await asyncio.sleep(0.05)
+
+    def record_success(self, latency: float) -> None:
+        if latency <= self._latency_target:
+            self._limit = min(self._max, self._limit + self._alpha)
+
+    def record_failure(self) -> None:
+        self._limit = max(self._min, self._limit * self._beta)
+        self._resume_at = time.monotonic() + self._cooldown
+        logger.warning(
+            "Rate-limit signal: concurrency reduced to %s, cooling down %.0fs",
+            self.limit,
+            self._cooldown,
+        )
+
+    @asynccontextmanager
+    async def slot(self):
+        """Acquire a concurrency slot; feeds latency/failure back to AIMD."""
+        await self._wait_for_slot()
+        self._in_flight += 1
+        start = time.monotonic()
+        try:
+            yield
+        except QuotaExhaustedError:
+            self.record_failure()
+            raise
+        else:
+            self.record_success(time.monotonic() - start)
+        finally:
+            self._in_flight -= 1
+
+
+# Shared per-process controller for all Gemini traffic.
+controller = AIMDController()
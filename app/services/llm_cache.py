@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+from typing import Any
+
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Default expiry for cached Gemini responses (seconds).
+DEFAULT_TTL = 600
+
+# Process-local L1 in front of Redis so repeated hits in the same worker
+# skip the network round-trip entirely.
+_l1: TTLCache = TTLCache(maxsize=1024, ttl=DEFAULT_TTL)
+
+_redis: aioredis.Redis | None = None
+
+
+def _get_redis() -> aioredis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(get_settings().REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def make_key(model: str, payload: Any) -> str:
+    """
+    Build an exact-match cache key from the model name and request payload.
+    The payload is canonicalized so dict ordering does not fragment the cache.
+    """
+    canonical = json.dumps(payload, sort_keys=True, default=str)
+    digest = hashlib.sha256(f"{model}|{canonical}".encode()).hexdigest()
+    return f"llm-cache:{digest}"
+
+
+async def get(key: str) -> Any | None:
+    """Return the cached value for `key`, or None on miss / Redis failure."""
+    if key in _l1:
+        return _l1[key]
+    try:
+        value = await _get_redis().get(key)
+    except Exception as exc:  # pragma: no cover - cache must never break calls
+        logger.debug("LLM cache read failed: %s", exc)
+        return None
+    if value is None:
+        return None
+    result = json.loads(value)
+    _l1[key] = result
+    return result
+
+
+async def put(key: str, value: Any, ttl: int = DEFAULT_TTL) -> None:
+    """Store `value` under `key` in both the L1 and Redis (best-effort)."""
+    _l1[key] = value
+    try:
+        await _get_redis().set(key, json.dumps(value), ex=ttl)
+    except Exception as exc:  # pragma: no cover - cache must never break calls
+        logger.debug("LLM cache write failed: %s", exc)
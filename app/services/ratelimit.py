@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import deque
+
+
+class SlidingWindow:
+    """
+    Client-side sliding one-minute RPM/TPM budget. Callers stall in
+    `wait_if_throttled` until the window has room, so we never pay the
+    wasted round-trip and cooldown of a synchronous 429 from the provider.
+    """
+
+    def __init__(self, rpm: int, tpm: int) -> None:
+        self._rpm = rpm
+        self._tpm = tpm
+        self._events: deque[tuple[float, int]] = deque()
+        self._tokens = 0
+
+    def _expire(self, now: float) -> None:
+        while self._events and now - self._events[0][0] >= 60.0:
+            _, tokens = self._events.popleft()
+            self._tokens -= tokens
+
+    async def wait_if_throttled(self, est_tokens: int = 0) -> None:
+        """Block until the request fits the window, then record it."""
+        # An estimate above the whole budget could never be admitted (and
+        # would index an empty deque below); clamp it so the request waits
+        # for a drained window instead of spinning or raising.
+        est_tokens = min(est_tokens, self._tpm)
+        while True:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self._events) < self._rpm and self._tokens + est_tokens <= self._tpm:
+                self._events.append((now, est_tokens))
+                self._tokens += est_tokens
+                return
+            # Sleep until the oldest entry ages out of the window
+            await asyncio.sleep(max(0.05, 60.0 - (now - self._events[0][0])))
+
+
+# Shared window for the reasoning model; defaults match the free-tier
+# limits noted in gemini_service's model configuration.
+reasoning_window = SlidingWindow(
+    rpm=int(os.getenv("GEMINI_RPM_LIMIT", "15")),
+    tpm=int(os.getenv("GEMINI_TPM_LIMIT", "1000000")),
+)
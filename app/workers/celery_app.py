@@ -1,12 +1,69 @@
 from __future__ import annotations
 
+import asyncio
+import logging
+import threading
+
+import orjson
+import redis
 from celery import Celery
+from celery.signals import worker_process_init
+from kombu import Queue
 
 from app.core.config import get_settings
 
 
+logger = logging.getLogger(__name__)
+
 settings = get_settings()
 
+# Synchronous publisher for worker-side progress events. Publishing needs no
+# event loop — a plain PUBLISH is microseconds — and the web processes'
+# socket_manager subscribers relay it to connected browsers.
+broadcaster = redis.Redis.from_url(settings.REDIS_URL)
+
+
+def notify(session_id: int, message: dict) -> None:
+    """Publish a progress event to the session's pub/sub channel."""
+    try:
+        broadcaster.publish(f"session:{session_id}", orjson.dumps(message))
+    except Exception as exc:  # pragma: no cover - notifications are best-effort
+        logger.debug("notify(%s) failed: %s", session_id, exc)
+
+
+# One persistent event loop per worker process, running on its own daemon
+# thread. The async resources workers share — the SQLAlchemy engine, Redis
+# clients and the cached genai client — are all bound to the loop that
+# created them, so under the threads pool every task thread must await them
+# on that same loop; run_async submits the coroutine there and blocks for
+# the result. Connection pools still survive across task invocations
+# instead of being torn down by asyncio.run on every task.
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None or _loop.is_closed():
+        with _loop_lock:
+            if _loop is None or _loop.is_closed():
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="worker-async-loop", daemon=True
+                ).start()
+                _loop = loop
+    return _loop
+
+
+@worker_process_init.connect
+def _init_event_loop(**_kwargs) -> None:  # pragma: no cover - worker hook
+    _get_loop()
+
+
+def run_async(coro):
+    """Run a coroutine to completion on the process's persistent event loop."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
 celery_app = Celery(
     "research_colossus",
     broker=settings.CELERY_BROKER_URL,
@@ -20,6 +77,23 @@ celery_app.conf.update(
     result_serializer="json",
     timezone="UTC",
     enable_utc=True,
+    # run_research_loop jobs run for minutes: take exactly one at a time
+    # (pair with -Ofair on the worker command line) and only ack on
+    # completion so unacked jobs survive worker death.
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+    # Separate queues per workload class so minutes-long research loops
+    # never starve short agent/admin work; workers can scale per queue
+    # (e.g. -Q research -c 2 vs -Q agents -c 8).
+    task_queues=(
+        Queue("research"),
+        Queue("agents"),
+        Queue("default"),
+    ),
+    task_default_queue="default",
+    # Redis broker: enable priority buckets for apply_async(priority=...).
+    # Note kombu's emulation dequeues priority 0 first, 9 last.
+    broker_transport_options={"priority_steps": list(range(10))},
 )
 
 
@@ -1,123 +1,340 @@
-from __future__ import annotations
-
-import asyncio
-from datetime import datetime
-
-from sqlmodel import select
-
-from app.db.models import AgentLog, ResearchBranch, ResearchSession, ResearchTask, KnowledgeFact
-from app.db.session import engine
-from app.services import gemini_service
-from app.services.gemini_service import QuotaExhaustedError
-from app.workers.celery_app import celery_app
-
-
-@celery_app.task(name="run_research_loop")
-def run_research_loop(session_id: int) -> None:
-    """
-    Celery task that drives a simple research loop for a session.
-    This is a simplified version of the frontend scheduler: it will
-    repeatedly pick the highest-priority pending task and run it.
-    """
-
-    async def _run() -> None:
-        from sqlmodel.ext.asyncio.session import AsyncSession
-
-        async with AsyncSession(engine) as session:
-            res = await session.exec(
-                select(ResearchSession).where(ResearchSession.id == session_id)
-            )
-            research_session = res.one_or_none()
-            if not research_session:
-                return
-
-            research_session.status = "running"
-            await session.commit()
-
-            try:
-                await _execute_research_loop(session, research_session, session_id)
-            except QuotaExhaustedError as e:
-                # Mark session as failed and log the quota error
-                research_session.status = "failed"
-                await session.commit()
-                log = AgentLog(
-                    session_id=session_id,
-                    agent_name="System",
-                    message=f"Research halted: {str(e)}",
-                    type="error",
-                    timestamp=datetime.utcnow(),
-                )
-                session.add(log)
-                await session.commit()
-                return
-
-        async def _execute_research_loop(session, research_session, session_id):
-            """Inner loop for research execution."""
-            while True:
-                # Fetch next pending task ordered by priority desc, then id
-                task_res = await session.exec(
-                    select(ResearchTask)
-                    .join(ResearchBranch)
-                    .where(
-                        ResearchBranch.session_id == session_id,
-                        ResearchTask.status == "pending",
-                    )
-                    .order_by(ResearchTask.priority.desc(), ResearchTask.id)
-                )
-                task = task_res.first()
-                if not task:
-                    break
-
-                task.status = "running"
-                await session.commit()
-
-                # Build simple knowledge context
-                facts_res = await session.exec(
-                    select(KnowledgeFact).where(KnowledgeFact.session_id == session_id)
-                )
-                facts = facts_res.all()
-                context = "\n".join(f"- [{f.source_agent}] {f.content}" for f in facts)
-
-                content, urls = await gemini_service.execute_agent_task(
-                    task_desc=task.description,
-                    role=task.assigned_to,
-                    context=context,
-                )
-
-                # Save result and mark as done
-                task.result = content
-                task.status = "done"
-                await session.commit()
-
-                # Log simple completion
-                log = AgentLog(
-                    session_id=session_id,
-                    agent_name=task.assigned_to,
-                    message=f"Completed task: {task.description[:100]}",
-                    type="success",
-                    timestamp=datetime.utcnow(),
-                )
-                session.add(log)
-                await session.commit()
-
-            # After all tasks are done, synthesize a final report
-            facts_res = await session.exec(
-                select(KnowledgeFact).where(KnowledgeFact.session_id == session_id)
-            )
-            facts = facts_res.all()
-            facts_payload = [
-                {"source_agent": f.source_agent, "content": f.content, "confidence": f.confidence}
-                for f in facts
-            ]
-            synthesis = await gemini_service.synthesize_research(
-                original_prompt=research_session.original_prompt,
-                knowledge_facts=facts_payload,
-            )
-
-            research_session.status = "completed"
-            research_session.final_synthesis = synthesis
-            await session.commit()
-
-    asyncio.run(_run())
-
-
+from __future__ import annotations
+
+import asyncio
+import os
+from datetime import datetime
+
+from celery import chord
+from sqlalchemy import insert, update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.db.models import AgentLog, ResearchBranch, ResearchSession, ResearchTask, KnowledgeFact
+from app.db.session import engine
+from app.services import backpressure, gemini_service
+from app.services.gemini_service import QuotaExhaustedError
+from app.workers.celery_app import celery_app, notify, run_async
+
+
+async def _persist_plan(session: AsyncSession, session_id: int, prompt: str, attachments: list) -> None:
+    """Ask Gemini for the research plan and bulk-persist branches/tasks."""
+    branches = await gemini_service.orchestrate_plan(prompt, attachments)
+
+    branch_objs = [
+        ResearchBranch(
+            session_id=session_id,
+            name=branch_data.get("name", "Branch"),
+            status="active",
+        )
+        for branch_data in branches
+    ]
+    session.add_all(branch_objs)
+    await session.flush()
+
+    # Core-level executemany: plans can carry hundreds of tasks, and plain
+    # dict rows skip per-row SQLModel construction/validation entirely.
+    now = datetime.utcnow()
+    task_rows = [
+        {
+            "branch_id": branch.id,
+            "description": task_data.get("description", ""),
+            "assigned_to": task_data.get("assigned_to", "Agent"),
+            "status": task_data.get("status", "pending"),
+            "priority": task_data.get("priority", 5),
+            "dependencies": task_data.get("dependencies") or [],
+            "created_at": now,
+        }
+        for branch, branch_data in zip(branch_objs, branches)
+        for task_data in branch_data.get("tasks", [])
+    ]
+    if task_rows:
+        await session.execute(insert(ResearchTask), task_rows)
+    await session.commit()
+
+
+# Retries (with exponential backoff) before a quota error fails a task.
+QUOTA_RETRIES = 3
+
+# Max knowledge facts fed into the final synthesis prompt (top by confidence).
+SYNTHESIS_FACT_CAP = int(os.getenv("SYNTHESIS_FACT_CAP", "500"))
+
+
+async def _top_facts(
+    session: AsyncSession, session_id: int, cap: int = SYNTHESIS_FACT_CAP
+) -> list[dict]:
+    """
+    Top-`cap` facts by confidence for the synthesis prompt, projected to the
+    three needed columns in SQL. Bounds both memory and LLM tokens no matter
+    how large the knowledge bank grows.
+    """
+    result = await session.execute(
+        select(
+            KnowledgeFact.source_agent,
+            KnowledgeFact.content,
+            KnowledgeFact.confidence,
+        )
+        .where(KnowledgeFact.session_id == session_id)
+        .order_by(KnowledgeFact.confidence.desc())
+        .limit(cap)
+    )
+    return [
+        {"source_agent": source_agent, "content": fact_content, "confidence": confidence}
+        for source_agent, fact_content, confidence in result
+    ]
+
+
+# Per-process context cache: session_id -> (last fact id, rendered lines).
+# Entries are replaced wholesale with fresh tuples, so concurrent worker
+# threads only ever observe a complete snapshot; synthesis evicts the entry.
+_CONTEXT_CACHE: dict[int, tuple[int, tuple[str, ...]]] = {}
+_CONTEXT_CACHE_MAX = 64
+
+
+async def _session_context(session: AsyncSession, session_id: int) -> str:
+    """
+    Render the session's knowledge bank into the agent context string.
+
+    Rendered lines are cached per process, so each call fetches and formats
+    only facts above the cached high-water mark and pays a single join —
+    not a full refetch and re-render of the whole bank per task.
+    """
+    last_id, parts = _CONTEXT_CACHE.get(session_id, (0, ()))
+    rows = await session.execute(
+        select(KnowledgeFact.id, KnowledgeFact.source_agent, KnowledgeFact.content)
+        .where(KnowledgeFact.session_id == session_id, KnowledgeFact.id > last_id)
+        .order_by(KnowledgeFact.id)
+    )
+    fresh = rows.all()
+    if fresh:
+        parts = parts + tuple(
+            f"- [{source_agent}] {fact_content}"
+            for _fact_id, source_agent, fact_content in fresh
+        )
+        if session_id not in _CONTEXT_CACHE and len(_CONTEXT_CACHE) >= _CONTEXT_CACHE_MAX:
+            _CONTEXT_CACHE.pop(next(iter(_CONTEXT_CACHE)), None)
+        _CONTEXT_CACHE[session_id] = (fresh[-1][0], parts)
+    return "\n".join(parts)
+
+
+async def _call_agent(description: str, assigned_to: str, context: str, session_id: int):
+    """Run one agent LLM call under AIMD backpressure with quota retries."""
+    for attempt in range(QUOTA_RETRIES + 1):
+        try:
+            async with backpressure.controller.slot():
+                return await gemini_service.execute_agent_task(
+                    task_desc=description,
+                    role=assigned_to,
+                    context=context,
+                    session_id=session_id,
+                )
+        except QuotaExhaustedError:
+            if attempt == QUOTA_RETRIES:
+                raise
+            await asyncio.sleep(5 * 2**attempt)
+
+
+@celery_app.task(name="run_single_task", queue="agents", acks_late=True, reject_on_worker_lost=True)
+def run_single_task(task_id: int, session_id: int) -> dict:
+    """
+    Claim and execute one ResearchTask end to end.
+
+    The claim is a conditional UPDATE (pending -> running), so a task
+    delivered twice — or raced by another worker — is simply skipped.
+    Failures are recorded on the task rather than raised, so the session's
+    chord still fires synthesis over whatever completed.
+
+    DB sessions are scoped to the claim and persist windows only: no pool
+    connection is checked out while the (multi-second) LLM call is in flight.
+    """
+
+    async def _run() -> dict:
+        async with AsyncSession(engine) as session:
+            res = await session.execute(
+                update(ResearchTask)
+                .where(ResearchTask.id == task_id, ResearchTask.status == "pending")
+                .values(status="running")
+                .returning(ResearchTask.description, ResearchTask.assigned_to)
+            )
+            row = res.first()
+            if row is None:
+                await session.commit()
+                return {"task_id": task_id, "ok": False, "skipped": True}
+            description, assigned_to = row
+            context = await _session_context(session, session_id)
+            await session.commit()
+
+        try:
+            content, urls = await _call_agent(description, assigned_to, context, session_id)
+        except Exception as exc:
+            async with AsyncSession(engine) as session:
+                await session.execute(
+                    update(ResearchTask)
+                    .where(ResearchTask.id == task_id)
+                    .values(status="failed")
+                )
+                session.add(
+                    AgentLog(
+                        session_id=session_id,
+                        agent_name=assigned_to,
+                        message=f"Task failed: {str(exc)[:200]}",
+                        type="error",
+                    )
+                )
+                await session.commit()
+            return {"task_id": task_id, "ok": False}
+
+        # Result and completion log land in one transaction
+        async with AsyncSession(engine) as session:
+            await session.execute(
+                update(ResearchTask)
+                .where(ResearchTask.id == task_id)
+                .values(result=content, status="done")
+            )
+            session.add(
+                AgentLog(
+                    session_id=session_id,
+                    agent_name=assigned_to,
+                    message=f"Completed task: {description[:100]}",
+                    type="success",
+                )
+            )
+            await session.commit()
+        return {"task_id": task_id, "ok": True}
+
+    result = run_async(_run())
+    # notify() is a blocking Redis publish — called here on the task thread,
+    # never inside _run, where it would stall the shared event loop.
+    if not result.get("skipped"):
+        event = "task_done" if result["ok"] else "task_failed"
+        notify(session_id, {"type": event, "task_id": task_id})
+    return result
+
+
+@celery_app.task(name="synthesize_session", queue="research", acks_late=True)
+def synthesize_session(_results, session_id: int) -> None:
+    """Chord callback: build the final report once all agent tasks finish."""
+    _CONTEXT_CACHE.pop(session_id, None)
+
+    async def _run() -> bool:
+        # Same session scoping as run_single_task: read, release, call the
+        # LLM without a pooled connection, then reconnect to write.
+        async with AsyncSession(engine) as session:
+            res = await session.exec(
+                select(ResearchSession.original_prompt).where(
+                    ResearchSession.id == session_id
+                )
+            )
+            original_prompt = res.one_or_none()
+            if original_prompt is None:
+                return False
+            facts_payload = await _top_facts(session, session_id)
+
+        synthesis = await gemini_service.synthesize_research(
+            original_prompt=original_prompt,
+            knowledge_facts=facts_payload,
+            session_id=session_id,
+        )
+
+        async with AsyncSession(engine) as session:
+            await session.execute(
+                update(ResearchSession)
+                .where(ResearchSession.id == session_id)
+                .values(status="completed", final_synthesis=synthesis)
+            )
+            await session.commit()
+        return True
+
+    if run_async(_run()):
+        notify(session_id, {"type": "status", "status": "completed"})
+
+
+@celery_app.task(name="run_research_loop", queue="research", acks_late=True, reject_on_worker_lost=True)
+def run_research_loop(session_id: int, prompt: str | None = None, attachments: list | None = None) -> None:
+    """
+    Dispatcher for a research session. When `prompt` is given it first
+    orchestrates the plan and persists branches/tasks (moved off the HTTP
+    request path), then fans each pending task out as an independent
+    run_single_task on the agents queue, with synthesize_session as the
+    chord callback once all of them finish.
+
+    Tasks therefore execute in parallel across the worker farm, retry
+    independently, and carry their own queue priority; the dispatcher
+    itself returns as soon as the fan-out is enqueued.
+    """
+
+    async def _run() -> tuple[str, object] | None:
+        async with AsyncSession(engine) as session:
+            # Bare UPDATE ... RETURNING: flips the status and confirms the
+            # session exists without hydrating the whole session graph
+            # (branches, tasks, logs and facts all default to lazy="selectin").
+            res = await session.execute(
+                update(ResearchSession)
+                .where(ResearchSession.id == session_id)
+                .values(status="running")
+                .returning(ResearchSession.id)
+            )
+            claimed = res.first()
+            await session.commit()
+            if claimed is None:
+                return None
+
+            try:
+                if prompt is not None:
+                    await _persist_plan(session, session_id, prompt, attachments or [])
+            except Exception as e:
+                # Any orchestration error — quota exhaustion, malformed plan
+                # JSON from the model — must mark the session failed, or it
+                # sits in "running" forever with no log and no status event.
+                message = (
+                    f"Research halted: {e}"
+                    if isinstance(e, QuotaExhaustedError)
+                    else f"Plan orchestration failed: {e}"
+                )
+                await session.execute(
+                    update(ResearchSession)
+                    .where(ResearchSession.id == session_id)
+                    .values(status="failed")
+                )
+                session.add(
+                    AgentLog(
+                        session_id=session_id,
+                        agent_name="System",
+                        message=message,
+                        type="error",
+                    )
+                )
+                await session.commit()
+                return ("failed", str(e))
+
+            rows = await session.execute(
+                select(ResearchTask.id, ResearchTask.priority)
+                .join(ResearchBranch, ResearchTask.branch_id == ResearchBranch.id)
+                .where(
+                    ResearchBranch.session_id == session_id,
+                    ResearchTask.status == "pending",
+                )
+                .order_by(ResearchTask.priority.desc(), ResearchTask.id)
+            )
+            return ("running", rows.all())
+
+    outcome = run_async(_run())
+    if outcome is None:
+        return
+    status, payload = outcome
+    if status == "failed":
+        notify(session_id, {"type": "status", "status": "failed", "detail": payload})
+        return
+    notify(session_id, {"type": "status", "status": "running"})
+    pending = payload
+    if not pending:
+        # Nothing to execute — go straight to synthesis
+        synthesize_session.delay(None, session_id)
+        return
+
+    # Redis broker priorities are inverted (0 dequeues first), while
+    # ResearchTask.priority is higher-is-more-important — map accordingly.
+    header = [
+        run_single_task.s(task_id, session_id).set(priority=max(0, 9 - priority))
+        for task_id, priority in pending
+    ]
+    chord(header)(synthesize_session.s(session_id))
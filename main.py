@@ -3,21 +3,30 @@ import asyncio
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 from app.api.routes import router as api_router
+from app.core.config import get_settings
+from app.core.socket_manager import socket_manager
 from app.db.session import init_db
 
 
 def create_app() -> FastAPI:
-    app = FastAPI(title="Research Colossus Backend", version="0.1.0")
+    app = FastAPI(
+        title="Research Colossus Backend",
+        version="0.1.0",
+        default_response_class=ORJSONResponse,
+    )
 
-    # CORS – allow local frontend by default; adjust in production
+    # CORS – explicit origin allow-list (CORS_ORIGINS env, comma-separated).
+    # A "*" entry alongside allow_credentials=True is both insecure and
+    # disables Starlette's fast-path origin check, so wildcards are out.
     app.add_middleware(
         CORSMiddleware,
-        allow_origins=["http://localhost:5173", "http://127.0.0.1:5173", "*"],
+        allow_origins=get_settings().CORS_ORIGINS,
         allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
+        allow_methods=["GET", "POST", "OPTIONS"],
+        allow_headers=["Authorization", "Content-Type"],
     )
 
     app.include_router(api_router)
@@ -25,6 +34,11 @@ def create_app() -> FastAPI:
     @app.on_event("startup")
     async def on_startup() -> None:  # pragma: no cover - side-effect hook
         await init_db()
+        await socket_manager.start()
+
+    @app.on_event("shutdown")
+    async def on_shutdown() -> None:  # pragma: no cover - side-effect hook
+        await socket_manager.stop()
 
     return app
 